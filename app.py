@@ -1,10 +1,21 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import hashlib
+import hmac
+import base64
+import bcrypt
+import re
 import time
 import io
+import os
+import tempfile
+import csv
+import queue
+import threading
+import logging
+from contextlib import contextmanager
 
 # ==============================================================================
 # CONFIGURAÇÕES GERAIS E ESTILO
@@ -22,14 +33,77 @@ LIMITE_LIVROS_POR_LEITOR = 3
 LIMITE_RENOVACOES = 2
 DB_FILE = "sgbc_rede_estadual.db"
 
+logger = logging.getLogger(__name__)
+
+# Consulta de login fixa (texto constante = reaproveitada pelo cache de statements do SQLite)
+# Join para pegar nome da biblioteca se existir; a senha é conferida em Python (bcrypt)
+_LOGIN_SQL = (
+    "SELECT u.id, u.name, u.role, u.library_id, l.name AS library_name, u.password "
+    "FROM users u LEFT JOIN libraries l ON u.library_id = l.id "
+    "WHERE u.email=? AND u.active=1"
+)
+
 # ==============================================================================
 # CAMADA DE DADOS (DATABASE & PERSISTÊNCIA)
 # ==============================================================================
 
 def get_connection():
-    """Cria conexão com thread check desligado para Streamlit Cloud"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    return conn
+    """Conexão persistente POR SESSÃO (reaproveitada entre reruns da mesma sessão).
+    Sessões diferentes nunca compartilham conexão, então a transação de um usuário
+    não se mistura com a de outro. Em autocommit: cada comando é gravado na hora,
+    escritas agrupadas usam transaction(). Liberada junto com o estado da sessão."""
+    if 'db_conn' not in st.session_state:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.row_factory = sqlite3.Row  # acesso por nome de coluna em leituras de linha única
+        st.session_state.db_conn = conn
+    return st.session_state.db_conn
+
+@contextmanager
+def transaction(conn):
+    """Agrupa escritas em uma única transação (um commit/fsync, tudo ou nada).
+    A conexão está em autocommit, então `with conn:` sozinho não abriria transação.
+    BEGIN IMMEDIATE reserva a escrita já no início: outra sessão espera o busy timeout
+    em vez de falhar no meio da transação ao tentar promover a leitura em escrita."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:  # inclui as exceções de controle do Streamlit (rerun/stop)
+        # A conexão vive a sessão toda: nunca deixá-la presa em transação aberta.
+        # Se o SQLite já desfez sozinho (disco cheio, I/O), não há o que desfazer.
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+def _bcrypt_input(password):
+    """bcrypt só aceita até 72 bytes (a 5.x lança ValueError acima disso): pré-hash
+    SHA-256 em base64 = 44 bytes fixos, sem byte nulo, para qualquer tamanho de senha"""
+    return base64.b64encode(hashlib.sha256(password.encode()).digest())
+
+def hash_pass(password):
+    """Hash de senha com bcrypt (salt aleatório, custo 12)"""
+    return bcrypt.hashpw(_bcrypt_input(password), bcrypt.gensalt(12)).decode()
+
+def is_legacy_hash(stored):
+    """Hashes antigos: SHA-256 hexadecimal sem salt"""
+    return not stored.startswith("$2")
+
+def verify_pass(password, stored):
+    """Confere a senha contra o hash salvo (bcrypt ou SHA-256 legado)"""
+    if not stored:
+        return False
+    if is_legacy_hash(stored):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    try:
+        return bcrypt.checkpw(_bcrypt_input(password), stored.encode())
+    except ValueError:  # hash salvo malformado
+        return False
 
 def init_db():
     """Inicializa o Schema do Banco de Dados conforme Dossiê"""
@@ -114,17 +188,51 @@ def init_db():
         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )''')
 
+    # 7. Índices (colunas usadas em WHERE/JOIN nas consultas frequentes)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_loans_user_status ON loans(user_id, status, due_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_loans_lib_status ON loans(library_id, status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_copies_lib_status ON copies(library_id, status, book_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_copies_book ON copies(book_id)")
+    # users.email já é indexado pelo UNIQUE (sqlite_autoindex_users_1)
+    c.execute("DROP INDEX IF EXISTS idx_users_email")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_role_lib ON users(role, library_id)")
+    # Busca por título/autor é atendida pelo FTS (books_fts) abaixo
+    c.execute("DROP INDEX IF EXISTS idx_books_title")
+    c.execute("DROP INDEX IF EXISTS idx_books_author")
+
+    # 8. Busca textual (FTS5 espelhando books, mantido por triggers)
+    c.execute("SELECT 1 FROM sqlite_master WHERE name='books_fts' LIMIT 1")
+    fts_novo = c.fetchone() is None
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title, author, isbn, category, content='books', content_rowid='id'
+    )''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, title, author, isbn, category)
+        VALUES (new.id, new.title, new.author, new.isbn, new.category);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, isbn, category)
+        VALUES ('delete', old.id, old.title, old.author, old.isbn, old.category);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, isbn, category)
+        VALUES ('delete', old.id, old.title, old.author, old.isbn, old.category);
+        INSERT INTO books_fts(rowid, title, author, isbn, category)
+        VALUES (new.id, new.title, new.author, new.isbn, new.category);
+    END''')
+    if fts_novo:
+        # Indexa obras já cadastradas antes da criação do FTS
+        c.execute("INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
+
     # Seed Inicial (Admin)
-    c.execute("SELECT * FROM users WHERE role='admin_rede'")
+    c.execute("SELECT 1 FROM users WHERE role='admin_rede' LIMIT 1")
     if not c.fetchone():
         # Senha padrão: admin123
-        pass_hash = hashlib.sha256("admin123".encode()).hexdigest()
+        pass_hash = hash_pass("admin123")
         c.execute("INSERT INTO users (name, email, password, role, active) VALUES (?, ?, ?, ?, 1)", 
                   ("Administração Central", "admin@rede.com", pass_hash, "admin_rede"))
         c.execute("INSERT INTO libraries (name, city) VALUES (?, ?)", ("Biblioteca Central (Sede)", "Capital"))
         
-    conn.commit()
-    conn.close()
 
 # Inicializa banco
 init_db()
@@ -133,45 +241,143 @@ init_db()
 # FUNÇÕES AUXILIARES (LÓGICA DE NEGÓCIO)
 # ==============================================================================
 
-def hash_pass(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+def _audit_worker(audit_q):
+    """Grava os logs de auditoria em lote (até 100 registros ou 1 segundo) em conexão própria.
+    Se a gravação falhar (ex.: 'database is locked'), mantém o lote e tenta de novo:
+    a thread nunca morre, senão a trilha LGPD pararia em silêncio."""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    batch = []
+    while True:
+        if not batch:
+            batch.append(audit_q.get())
+        deadline = time.monotonic() + 1
+        while len(batch) < 100:
+            try:
+                batch.append(audit_q.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            conn.executemany("INSERT INTO audit_logs (action, user_id, details, timestamp) VALUES (?, ?, ?, ?)", batch)
+            conn.commit()
+            batch = []
+        except sqlite3.Error:
+            logger.exception("Falha ao gravar %d registros de auditoria; nova tentativa em 1s", len(batch))
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            time.sleep(1)
+
+@st.cache_resource
+def get_audit_queue():
+    """Fila de auditoria + thread consumidora (criadas uma única vez por processo)"""
+    audit_q = queue.Queue()
+    threading.Thread(target=_audit_worker, args=(audit_q,), daemon=True).start()
+    return audit_q
 
 def log_audit(action, details):
-    """Registra ações críticas para conformidade LGPD"""
+    """Registra ações críticas para conformidade LGPD (gravação em segundo plano).
+    O horário é capturado aqui, no momento da ação (UTC, mesmo formato do CURRENT_TIMESTAMP),
+    e não quando a thread grava o lote."""
     if st.session_state.user:
         user_id = st.session_state.user['id']
-        conn = get_connection()
-        conn.execute("INSERT INTO audit_logs (action, user_id, details) VALUES (?, ?, ?)", 
-                     (action, user_id, str(details)))
-        conn.commit()
-        conn.close()
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        get_audit_queue().put((action, user_id, str(details), timestamp))
 
 def check_leitor_elegivel(user_id):
     """Verifica regras: Bloqueio por atraso e Limite de itens"""
     conn = get_connection()
-    
+    hoje = datetime.now().strftime('%Y-%m-%d')
+
+    # Situação do leitor + contagem de atrasos e itens ativos em uma única consulta
+    user = conn.execute("""
+        SELECT u.active, u.blocked_until,
+               COALESCE(SUM(l.status='aberto' AND l.due_date < ?), 0) AS atrasos,
+               COALESCE(SUM(l.status='aberto'), 0) AS ativos
+        FROM users u
+        LEFT JOIN loans l ON l.user_id = u.id
+        WHERE u.id = ?
+        GROUP BY u.id
+    """, (hoje, int(user_id))).fetchone()
+
     # 1. Verificar bloqueio
-    user = pd.read_sql(f"SELECT active, blocked_until FROM users WHERE id={user_id}", conn).iloc[0]
     if user['active'] == 0:
         return False, "Usuário inativo."
     
-    if user['blocked_until'] and user['blocked_until'] >= datetime.now().strftime('%Y-%m-%d'):
+    if user['blocked_until'] and user['blocked_until'] >= hoje:
         return False, f"Usuário bloqueado até {user['blocked_until']} por atrasos anteriores."
 
     # 2. Verificar atrasos atuais (itens não devolvidos e vencidos)
-    hoje = datetime.now().strftime('%Y-%m-%d')
-    atrasos = pd.read_sql(f"SELECT count(*) FROM loans WHERE user_id={user_id} AND status='aberto' AND due_date < '{hoje}'", conn).iloc[0,0]
-    if atrasos > 0:
+    if user['atrasos'] > 0:
         return False, "Usuário possui itens em atraso. Regularize antes de novos empréstimos."
 
     # 3. Verificar limite de quantidade
-    ativos = pd.read_sql(f"SELECT count(*) FROM loans WHERE user_id={user_id} AND status='aberto'", conn).iloc[0,0]
-    if ativos >= LIMITE_LIVROS_POR_LEITOR:
+    if user['ativos'] >= LIMITE_LIVROS_POR_LEITOR:
         return False, f"Limite de empréstimos atingido ({LIMITE_LIVROS_POR_LEITOR} itens)."
 
-    conn.close()
     return True, "Elegível"
 
+@st.cache_data(ttl=300)
+def list_active_libraries():
+    """Bibliotecas ativas (cache: muda raramente)"""
+    return pd.read_sql("SELECT id, name FROM libraries WHERE active=1", get_connection())
+
+def fts_query(termo):
+    """Converte o texto digitado em expressão MATCH segura: cada palavra vira prefixo entre aspas"""
+    return " ".join(f'"{palavra}"*' for palavra in re.findall(r"\w+", termo))
+
+@st.cache_data(ttl=30)
+def search_catalog(termo, filtro_lib):
+    """Busca pública de exemplares por título/autor/ISBN via FTS5 (cache por termo + filtro)"""
+    match = fts_query(termo)
+    if not match:
+        return pd.DataFrame()
+
+    query = """
+        SELECT b.title, b.author, b.category, l.name as library, c.status
+        FROM copies c
+        JOIN books b ON c.book_id = b.id
+        JOIN libraries l ON c.library_id = l.id
+        WHERE b.id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)
+    """
+    params = [match]
+    
+    if filtro_lib != "Todas":
+        query += " AND l.name = ?"
+        params.append(filtro_lib)
+        
+    return pd.read_sql(query, get_connection(), params=params)
+
+def backup_db_bytes():
+    """Cópia consistente do banco via API de backup do SQLite (respeita transações/WAL)"""
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        dest = sqlite3.connect(path)
+        with dest:
+            get_connection().backup(dest)
+        dest.close()
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+def stream_loans_csv(conn, lib_id, chunk_size=5000):
+    """Gera o CSV de empréstimos da biblioteca em blocos (sem montar tudo em memória)"""
+    cur = conn.execute("""
+        SELECT id, loan_date, due_date, return_date, status
+        FROM loans WHERE library_id=? ORDER BY id
+    """, (lib_id,))
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([d[0] for d in cur.description])
+    while rows := cur.fetchmany(chunk_size):
+        writer.writerows(rows)
+        yield buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
 # ==============================================================================
 # INTERFACE DE USUÁRIO (FRONTEND)
 # ==============================================================================
@@ -197,10 +403,10 @@ def login_sidebar():
             
             # Botão de Backup Crítico
             st.divider()
-            with open(DB_FILE, "rb") as f:
+            if st.button("Gerar backup", help="Baixe semanalmente para evitar perda de dados no servidor gratuito."):
                 st.download_button(
                     label="💾 BACKUP DE DADOS",
-                    data=f,
+                    data=backup_db_bytes(),
                     file_name=f"backup_sgbc_{datetime.now().strftime('%Y%m%d')}.db",
                     mime="application/x-sqlite3",
                     help="Baixe semanalmente para evitar perda de dados no servidor gratuito."
@@ -212,22 +418,17 @@ def login_sidebar():
                 pwd = st.text_input("Senha", type="password")
                 if st.form_submit_button("Entrar"):
                     conn = get_connection()
-                    c = conn.cursor()
-                    # Join para pegar nome da biblioteca se existir
-                    query = """
-                        SELECT u.id, u.name, u.role, u.library_id, l.name as library_name 
-                        FROM users u 
-                        LEFT JOIN libraries l ON u.library_id = l.id 
-                        WHERE u.email=? AND u.password=? AND u.active=1
-                    """
-                    c.execute(query, (email, hash_pass(pwd)))
-                    data = c.fetchone()
-                    conn.close()
+                    data = conn.execute(_LOGIN_SQL, (email,)).fetchone()
                     
-                    if data:
+                    if data and verify_pass(pwd, data['password']):
+                        # Migração: regrava hashes SHA-256 antigos como bcrypt
+                        if is_legacy_hash(data['password']):
+                            novo_hash = hash_pass(pwd)
+                            with transaction(conn):
+                                conn.execute("UPDATE users SET password=? WHERE id=?", (novo_hash, data['id']))
                         st.session_state.user = {
-                            "id": data[0], "name": data[1], "role": data[2], 
-                            "library_id": data[3], "library_name": data[4]
+                            "id": data['id'], "name": data['name'], "role": data['role'], 
+                            "library_id": data['library_id'], "library_name": data['library_name']
                         }
                         st.rerun()
                     else:
@@ -246,28 +447,11 @@ def page_public_search():
     with col1:
         termo = st.text_input("Digite Título, Autor ou ISBN", placeholder="Ex: Dom Casmurro...")
     with col2:
-        conn = get_connection()
-        libs = pd.read_sql("SELECT id, name FROM libraries WHERE active=1", conn)
+        libs = list_active_libraries()
         filtro_lib = st.selectbox("Filtrar por Biblioteca", ["Todas"] + libs['name'].tolist())
-        conn.close()
 
     if termo:
-        conn = get_connection()
-        query = """
-            SELECT b.title, b.author, b.category, l.name as library, c.status
-            FROM copies c
-            JOIN books b ON c.book_id = b.id
-            JOIN libraries l ON c.library_id = l.id
-            WHERE (b.title LIKE ? OR b.author LIKE ?)
-        """
-        params = [f'%{termo}%', f'%{termo}%']
-        
-        if filtro_lib != "Todas":
-            query += " AND l.name = ?"
-            params.append(filtro_lib)
-            
-        df = pd.read_sql(query, conn, params=params)
-        conn.close()
+        df = search_catalog(termo, filtro_lib)
 
         if not df.empty:
             for _, row in df.iterrows():
@@ -288,9 +472,11 @@ def page_admin_dashboard():
     
     # KPIs
     conn = get_connection()
-    total_lib = pd.read_sql("SELECT count(*) FROM libraries", conn).iloc[0,0]
-    total_books = pd.read_sql("SELECT count(*) FROM books", conn).iloc[0,0]
-    total_loans = pd.read_sql("SELECT count(*) FROM loans WHERE status='aberto'", conn).iloc[0,0]
+    total_lib, total_books, total_loans = conn.execute("""
+        SELECT (SELECT count(*) FROM libraries),
+               (SELECT count(*) FROM books),
+               (SELECT count(*) FROM loans WHERE status='aberto')
+    """).fetchone()
     
     c1, c2, c3 = st.columns(3)
     c1.metric("Bibliotecas Ativas", total_lib)
@@ -308,8 +494,9 @@ def page_admin_dashboard():
                 city = st.text_input("Cidade/Bairro")
                 addr = st.text_input("Endereço Completo")
                 if st.form_submit_button("Salvar"):
-                    conn.execute("INSERT INTO libraries (name, city, address) VALUES (?, ?, ?)", (name, city, addr))
-                    conn.commit()
+                    with transaction(conn):
+                        conn.execute("INSERT INTO libraries (name, city, address) VALUES (?, ?, ?)", (name, city, addr))
+                    list_active_libraries.clear()
                     log_audit("create_library", f"Criou biblioteca {name}")
                     st.success("Biblioteca criada!")
                     st.rerun()
@@ -317,23 +504,27 @@ def page_admin_dashboard():
 
     with tab2:
         st.caption("Cadastre Coordenadores para as bibliotecas.")
-        libs_df = pd.read_sql("SELECT id, name FROM libraries WHERE active=1", conn)
-        with st.form("new_staff"):
-            c1, c2 = st.columns(2)
-            nome = c1.text_input("Nome Completo")
-            email = c1.text_input("E-mail de Login")
-            pwd = c2.text_input("Senha Inicial", type="password")
-            lib_idx = c2.selectbox("Vincular à Biblioteca", libs_df['name'])
-            
-            if st.form_submit_button("Cadastrar Coordenador"):
-                lib_id = libs_df[libs_df['name'] == lib_idx]['id'].values[0]
-                try:
-                    conn.execute("INSERT INTO users (name, email, password, role, library_id, active) VALUES (?, ?, ?, 'coord_local', ?, 1)",
-                                 (nome, email, hash_pass(pwd), int(lib_id)))
-                    conn.commit()
-                    st.success("Usuário criado com sucesso!")
-                except sqlite3.IntegrityError:
-                    st.error("E-mail já cadastrado.")
+        libs_df = list_active_libraries()
+        lib_names = dict(zip(libs_df['id'].tolist(), libs_df['name']))
+        if not lib_names:
+            st.warning("Cadastre uma biblioteca ativa antes de criar coordenadores.")
+        else:
+            with st.form("new_staff"):
+                c1, c2 = st.columns(2)
+                nome = c1.text_input("Nome Completo")
+                email = c1.text_input("E-mail de Login")
+                pwd = c2.text_input("Senha Inicial", type="password")
+                lib_id = c2.selectbox("Vincular à Biblioteca", list(lib_names.keys()), format_func=lib_names.get)
+                
+                if st.form_submit_button("Cadastrar Coordenador"):
+                    try:
+                        pass_hash = hash_pass(pwd)  # fora da transação: bcrypt é lento de propósito
+                        with transaction(conn):
+                            conn.execute("INSERT INTO users (name, email, password, role, library_id, active) VALUES (?, ?, ?, 'coord_local', ?, 1)",
+                                         (nome, email, pass_hash, int(lib_id)))
+                        st.success("Usuário criado com sucesso!")
+                    except sqlite3.IntegrityError:
+                        st.error("E-mail já cadastrado.")
 
     with tab3:
         st.info("Este é o cadastro bibliográfico único (título/autor) compartilhado por toda a rede.")
@@ -344,11 +535,10 @@ def page_admin_dashboard():
             cat = c1.text_input("Categoria/Gênero")
             isbn = c2.text_input("ISBN")
             if st.form_submit_button("Adicionar ao Catálogo Geral"):
-                conn.execute("INSERT INTO books (title, author, category, isbn) VALUES (?, ?, ?, ?)", (tit, aut, cat, isbn))
-                conn.commit()
+                with transaction(conn):
+                    conn.execute("INSERT INTO books (title, author, category, isbn) VALUES (?, ?, ?, ?)", (tit, aut, cat, isbn))
+                search_catalog.clear()
                 st.success("Obra adicionada! Agora as bibliotecas podem vincular exemplares.")
-    
-    conn.close()
 
 def page_library_ops():
     """Módulo 3: Operação Local (Bibliotecário/Voluntário)"""
@@ -371,24 +561,24 @@ def page_library_ops():
             st.subheader("📤 Novo Empréstimo")
             
             # Buscas otimizadas
-            leitores = pd.read_sql(f"SELECT id, name, document FROM users WHERE role='leitor' AND active=1", conn)
+            leitores = pd.read_sql("SELECT id, name, document FROM users WHERE role='leitor' AND active=1", conn)
             # Exemplares disponiveis APENAS DESTA BIBLIOTECA
-            exemplares = pd.read_sql(f"""
+            exemplares = pd.read_sql("""
                 SELECT c.id, b.title, c.code 
                 FROM copies c 
                 JOIN books b ON c.book_id = b.id 
-                WHERE c.library_id={user_lib_id} AND c.status='disponivel'
-            """, conn)
+                WHERE c.library_id=? AND c.status='disponivel'
+            """, conn, params=(user_lib_id,))
 
             if not leitores.empty and not exemplares.empty:
-                l_sel = st.selectbox("Leitor", leitores['name'] + " | Doc: " + leitores['document'].fillna(''))
-                e_sel = st.selectbox("Livro Disponível", exemplares['title'] + " | Cód: " + exemplares['code'])
+                name_map = dict(zip(leitores['id'].tolist(), leitores['name'] + " | Doc: " + leitores['document'].fillna('')))
+                copy_map = dict(zip(exemplares['id'].tolist(), exemplares['title'] + " | Cód: " + exemplares['code']))
+                code_map = dict(zip(exemplares['id'].tolist(), exemplares['code']))
+                l_id = st.selectbox("Leitor", list(name_map.keys()), format_func=name_map.get)
+                e_id = st.selectbox("Livro Disponível", list(copy_map.keys()), format_func=copy_map.get)
                 
                 if st.button("Confirmar Saída"):
-                    # Identificar IDs
-                    l_id = leitores[leitores['name'] == l_sel.split(" |")[0]]['id'].values[0]
-                    e_code = e_sel.split(" | Cód: ")[1]
-                    e_id = exemplares[exemplares['code'] == e_code]['id'].values[0]
+                    e_code = code_map[e_id]
                     
                     # Validar Regras
                     elegivel, msg = check_leitor_elegivel(l_id)
@@ -397,10 +587,11 @@ def page_library_ops():
                         dt_hoje = datetime.now()
                         dt_prazo = dt_hoje + timedelta(days=PRAZO_PADRAO_DIAS)
                         
-                        conn.execute("INSERT INTO loans (user_id, copy_id, library_id, loan_date, due_date) VALUES (?, ?, ?, ?, ?)",
-                                     (int(l_id), int(e_id), user_lib_id, dt_hoje, dt_prazo))
-                        conn.execute(f"UPDATE copies SET status='emprestado' WHERE id={e_id}")
-                        conn.commit()
+                        with transaction(conn):
+                            conn.execute("INSERT INTO loans (user_id, copy_id, library_id, loan_date, due_date) VALUES (?, ?, ?, ?, ?)",
+                                         (int(l_id), int(e_id), user_lib_id, dt_hoje, dt_prazo))
+                            conn.execute("UPDATE copies SET status='emprestado' WHERE id=?", (int(e_id),))
+                        search_catalog.clear()
                         log_audit("loan_create", f"Empréstimo exemplar {e_code} para user {l_id}")
                         st.success(f"Empréstimo realizado! Devolução prevista: {dt_prazo.strftime('%d/%m/%Y')}")
                         time.sleep(2)
@@ -413,48 +604,60 @@ def page_library_ops():
         # COLUNA 2: DEVOLUÇÃO
         with c2.container(border=True):
             st.subheader("📥 Devolução")
-            # Buscar empréstimos abertos DESTA biblioteca
-            loans = pd.read_sql(f"""
+            filtro = st.text_input("Buscar leitor/código")
+            # Buscar empréstimos abertos DESTA biblioteca (filtrados e limitados no banco)
+            loans = pd.read_sql("""
                 SELECT l.id, u.name, b.title, l.due_date, c.code
                 FROM loans l 
                 JOIN users u ON l.user_id = u.id
                 JOIN copies c ON l.copy_id = c.id
                 JOIN books b ON c.book_id = b.id
-                WHERE l.library_id={user_lib_id} AND l.status='aberto'
-            """, conn)
+                WHERE l.library_id=? AND l.status='aberto'
+                  AND (u.name LIKE ? OR c.code LIKE ?)
+                ORDER BY l.due_date
+                LIMIT 50
+            """, conn, params=(user_lib_id, f"%{filtro}%", f"%{filtro}%"))
             
             if not loans.empty:
-                loan_sel = st.selectbox("Selecione o Item Retornado", 
-                                       f"{loans['title']} ({loans['code']}) - {loans['name']}")
+                loan_labels = dict(zip(loans['id'].tolist(),
+                                       loans['title'] + " (" + loans['code'] + ") - " + loans['name']))
+                loan_id = st.selectbox("Selecione o Item Retornado", list(loan_labels.keys()),
+                                       format_func=loan_labels.get)
                 
                 if st.button("Confirmar Devolução"):
-                    # Parsing seleção
-                    code_temp = loan_sel.split("(")[1].split(")")[0]
-                    loan_id = loans[loans['code'] == code_temp]['id'].values[0]
-                    
-                    # Lógica de Atraso
-                    loan_data = pd.read_sql(f"SELECT user_id, due_date, copy_id FROM loans WHERE id={loan_id}", conn).iloc[0]
-                    dt_due = datetime.strptime(loan_data['due_date'], '%Y-%m-%d')
-                    dt_now = datetime.now()
-                    
                     msg_extra = ""
-                    # Se atrasou, bloqueia
-                    if dt_now > dt_due + timedelta(days=1): # Tolerancia de 1 dia
-                        dias_atraso = (dt_now - dt_due).days
-                        # Bloqueio simples: dias de atraso * 2
-                        dt_unlock = dt_now + timedelta(days=dias_atraso * 2)
-                        conn.execute("UPDATE users SET blocked_until=? WHERE id=?", (dt_unlock, int(loan_data['user_id'])))
-                        msg_extra = f"⚠️ Atraso de {dias_atraso} dias. Leitor bloqueado até {dt_unlock.strftime('%d/%m/%Y')}."
-
-                    conn.execute(f"UPDATE loans SET status='devolvido', return_date='{dt_now}' WHERE id={loan_id}")
-                    conn.execute(f"UPDATE copies SET status='disponivel' WHERE id={loan_data['copy_id']}")
-                    conn.commit()
+                    with transaction(conn):
+                        # Lógica de Atraso (no banco): tolerância de 1 dia, bloqueio = dias de atraso * 2
+                        # (subconsultas simples: sem UPDATE ... FROM/RETURNING, que exigem SQLite >= 3.33/3.35)
+                        cur = conn.execute("""
+                            UPDATE users
+                            SET blocked_until = (
+                                SELECT date('now', 'localtime',
+                                    '+' || (2 * CAST(julianday('now', 'localtime') - julianday(due_date) AS INTEGER)) || ' days')
+                                FROM loans WHERE id = ?)
+                            WHERE id = (
+                                SELECT user_id FROM loans
+                                WHERE id = ? AND julianday('now', 'localtime') > julianday(due_date) + 1)
+                        """, (loan_id, loan_id))
+                        bloqueio = None
+                        if cur.rowcount:
+                            bloqueio = conn.execute("""
+                                SELECT CAST((julianday(blocked_until) - julianday('now', 'localtime', 'start of day')) / 2 AS INTEGER) AS dias_atraso,
+                                       strftime('%d/%m/%Y', blocked_until) AS dt_unlock
+                                FROM users WHERE id = (SELECT user_id FROM loans WHERE id = ?)
+                            """, (loan_id,)).fetchone()
+                        if bloqueio:
+                            msg_extra = f"⚠️ Atraso de {bloqueio['dias_atraso']} dias. Leitor bloqueado até {bloqueio['dt_unlock']}."
+
+                        conn.execute("UPDATE loans SET status='devolvido', return_date=? WHERE id=?", (datetime.now(), loan_id))
+                        conn.execute("UPDATE copies SET status='disponivel' WHERE id=(SELECT copy_id FROM loans WHERE id=?)", (loan_id,))
+                    search_catalog.clear()
                     log_audit("loan_return", f"Devolução id {loan_id}. {msg_extra}")
                     st.success(f"Devolução registrada! {msg_extra}")
                     time.sleep(3)
                     st.rerun()
             else:
-                st.info("Nenhum empréstimo pendente nesta unidade.")
+                st.info("Nenhum empréstimo pendente encontrado nesta unidade.")
 
     # --- ABA ACERVO ---
     elif ops_tab == "Acervo (Exemplares)":
@@ -465,30 +668,28 @@ def page_library_ops():
         
         with st.form("add_copy"):
             c1, c2 = st.columns([3, 1])
-            book_sel = c1.selectbox("Selecione a Obra (Catálogo Geral)", books['title'] + " - " + books['author'])
+            book_map = dict(zip(books['id'].tolist(), books['title'] + " - " + books['author']))
+            b_id = c1.selectbox("Selecione a Obra (Catálogo Geral)", list(book_map.keys()), format_func=book_map.get)
             code = c2.text_input("Código de Barras/Etiqueta")
             
             if st.form_submit_button("Adicionar Exemplar ao Acervo"):
-                # Obter ID do livro
-                b_title = book_sel.split(" - ")[0]
-                b_id = books[books['title'] == b_title]['id'].values[0]
-                
                 try:
-                    conn.execute("INSERT INTO copies (book_id, library_id, code, status) VALUES (?, ?, ?, 'disponivel')",
-                                 (int(b_id), user_lib_id, code))
-                    conn.commit()
+                    with transaction(conn):
+                        conn.execute("INSERT INTO copies (book_id, library_id, code, status) VALUES (?, ?, ?, 'disponivel')",
+                                     (int(b_id), user_lib_id, code))
+                    search_catalog.clear()
                     st.success("Exemplar cadastrado!")
                     st.rerun()
                 except sqlite3.IntegrityError:
                     st.error("Erro: Já existe um exemplar com esse código nesta biblioteca.")
 
         # Listagem
-        my_copies = pd.read_sql(f"""
+        my_copies = pd.read_sql("""
             SELECT c.code, b.title, b.author, c.status 
             FROM copies c JOIN books b ON c.book_id = b.id 
-            WHERE c.library_id={user_lib_id}
+            WHERE c.library_id=?
             ORDER BY c.status, b.title
-        """, conn)
+        """, conn, params=(user_lib_id,))
         st.dataframe(my_copies, use_container_width=True)
 
     # --- ABA LEITORES ---
@@ -506,45 +707,51 @@ def page_library_ops():
             if st.form_submit_button("Cadastrar Leitor"):
                 if lgpd:
                     try:
-                        conn.execute("INSERT INTO users (name, email, document, role, library_id, lgpd_consent, active) VALUES (?, ?, ?, 'leitor', ?, 1, 1)",
-                                     (nome, email, doc, user_lib_id))
-                        conn.commit()
+                        with transaction(conn):
+                            conn.execute("INSERT INTO users (name, email, document, role, library_id, lgpd_consent, active) VALUES (?, ?, ?, 'leitor', ?, 1, 1)",
+                                         (nome, email, doc, user_lib_id))
                         st.success("Leitor cadastrado com sucesso!")
                     except:
                         st.error("Erro: Contato já cadastrado no sistema.")
                 else:
                     st.error("O consentimento LGPD é obrigatório para o cadastro.")
         
-        readers = pd.read_sql(f"SELECT name, email, active, blocked_until FROM users WHERE role='leitor' AND library_id={user_lib_id}", conn)
+        readers = pd.read_sql("SELECT name, email, active, blocked_until FROM users WHERE role='leitor' AND library_id=?", conn, params=(user_lib_id,))
         st.dataframe(readers, use_container_width=True)
 
     # --- ABA RELATÓRIOS ---
     elif ops_tab == "Relatórios":
         st.markdown("### 📈 Indicadores Locais")
         
-        # Dados
-        loans_hist = pd.read_sql(f"SELECT loan_date, status FROM loans WHERE library_id={user_lib_id}", conn)
-        if not loans_hist.empty:
-            loans_hist['loan_date'] = pd.to_datetime(loans_hist['loan_date'])
-            
+        # Dados (agregados no banco: uma linha por mês/status)
+        por_mes = pd.read_sql("""
+            SELECT strftime('%Y-%m', loan_date) AS m, COUNT(*) AS n
+            FROM loans WHERE library_id=?
+            GROUP BY m ORDER BY m
+        """, conn, params=(user_lib_id,)).set_index('m')['n']
+        if not por_mes.empty:
             c1, c2 = st.columns(2)
             
             # Gráfico de Empréstimos por mês
-            por_mes = loans_hist.groupby(loans_hist['loan_date'].dt.strftime('%Y-%m')).size()
             c1.bar_chart(por_mes)
             c1.caption("Empréstimos por Mês")
             
             # Status
-            status_dist = loans_hist['status'].value_counts()
+            status_dist = pd.read_sql("""
+                SELECT status, COUNT(*) AS count
+                FROM loans WHERE library_id=?
+                GROUP BY status ORDER BY count DESC
+            """, conn, params=(user_lib_id,)).set_index('status')['count']
             c2.write("Status dos Empréstimos")
             c2.dataframe(status_dist, use_container_width=True)
             
-            st.download_button("Exportar Relatório CSV", loans_hist.to_csv(), "relatorio_emprestimos.csv")
+            # CSV gerado apenas sob demanda
+            if st.button("Gerar Relatório CSV"):
+                st.download_button("Exportar Relatório CSV", b"".join(stream_loans_csv(conn, user_lib_id)),
+                                   "relatorio_emprestimos.csv", mime="text/csv")
         else:
             st.info("Ainda não há dados suficientes para gerar gráficos.")
 
-    conn.close()
-
 # ==============================================================================
 # MAIN APP LOOP
 # ==============================================================================